@@ -21,8 +21,9 @@
 # piping detection and popen() added by other android team members
 
 
-import os, sys, re, StringIO
+import os, sys, re
 import fcntl, termios, struct
+import select, time
 
 # unpack the current terminal width/height
 data = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, '1234')
@@ -47,15 +48,11 @@ def format(fg=None, bg=None, bright=False, bold=False, dim=False, reset=False):
 
 def indent_wrap(message, indent=0, width=80):
     wrap_area = width - indent
-    messagebuf = StringIO.StringIO()
-    current = 0
-    while current < len(message):
-        next = min(current + wrap_area, len(message))
-        messagebuf.write(message[current:next])
-        if next < len(message):
-            messagebuf.write("\n%s" % (" " * indent))
-        current = next
-    return messagebuf.getvalue()
+    if len(message) <= wrap_area:
+        return message
+    return ("\n" + " " * indent).join(
+        [message[current:current + wrap_area]
+         for current in range(0, len(message), wrap_area)])
 
 
 LAST_USED = [RED,GREEN,YELLOW,BLUE,MAGENTA,CYAN,WHITE]
@@ -94,6 +91,16 @@ TAGTYPES = {
     "E": "%s%s%s " % (format(fg=BLACK, bg=RED), "E".center(TAGTYPE_WIDTH), format(reset=True)),
 }
 
+# escape sequences used for every line, so format() isn't called per line
+RESET = format(reset=True)
+OWNER_FORMAT = format(fg=BLACK, bg=BLACK, bright=True)
+TAG_FORMATS = dict([(color, format(fg=color, dim=False)) for color in range(8)])
+
+# output is collected and written in batches: once BATCH_SIZE bytes are
+# pending, or when no more input arrived for FLUSH_INTERVAL seconds
+BATCH_SIZE = 64 * 1024
+FLUSH_INTERVAL = 0.05
+
 retag = re.compile("^([A-Z])/([^\(]+)\(([^\)]+)\): (.*)$")
 
 # to pick up -d or -e
@@ -105,54 +112,97 @@ if os.isatty(sys.stdin.fileno()):
 else:
     input = sys.stdin
 
-while True:
-    try:
-        line = input.readline()
-    except KeyboardInterrupt:
-        break
-
+def format_line(line):
+    # returns None for an unknown tag type
     match = retag.match(line)
-    if not match is None:
-        tagtype, tag, owner, message = match.groups()
-        linebuf = StringIO.StringIO()
-
-        # center process info
-        if PROCESS_WIDTH > 0:
-            owner = owner.strip().center(PROCESS_WIDTH)
-            linebuf.write("%s%s%s " % (format(fg=BLACK, bg=BLACK, bright=True), owner, format(reset=True)))
-
-        # right-align tag title and allocate color if needed
-        tag = tag.strip()
-        color = allocate_color(tag)
-        tag = tag[-TAG_WIDTH:].rjust(TAG_WIDTH)
-        linebuf.write("%s%s %s" % (format(fg=color, dim=False), tag, format(reset=True)))
-
-        # write out tagtype colored edge
-        if not tagtype in TAGTYPES: break
-        linebuf.write(TAGTYPES[tagtype])
-
-        # insert line wrapping as needed
-        message = indent_wrap(message, HEADER_SIZE, WIDTH)
-
-        # format tag message using rules
-        for matcher in RULES:
-            replace = RULES[matcher]
-            message = matcher.sub(replace, message)
-
-        linebuf.write(message)
-        line = linebuf.getvalue()
-
-    print line
-    if len(line) == 0: break
-
-
-
-
-
-
-
-
-
-
-
-
+    if match is None:
+        return line
+
+    tagtype, tag, owner, message = match.groups()
+    if not tagtype in TAGTYPES: return None
+    parts = []
+
+    # center process info
+    if PROCESS_WIDTH > 0:
+        owner = owner.strip().center(PROCESS_WIDTH)
+        parts.append("%s%s%s " % (OWNER_FORMAT, owner, RESET))
+
+    # right-align tag title and allocate color if needed
+    tag = tag.strip()
+    color = allocate_color(tag)
+    tag = tag[-TAG_WIDTH:].rjust(TAG_WIDTH)
+    parts.append("%s%s %s" % (TAG_FORMATS[color], tag, RESET))
+
+    # write out tagtype colored edge
+    parts.append(TAGTYPES[tagtype])
+
+    # insert line wrapping as needed
+    message = indent_wrap(message, HEADER_SIZE, WIDTH)
+
+    # format tag message using rules
+    for matcher in RULES:
+        replace = RULES[matcher]
+        message = matcher.sub(replace, message)
+
+    parts.append(message)
+    return "".join(parts)
+
+
+class BatchWriter(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.pending = []
+        self.size = 0
+        self.since = None
+
+    def write(self, data):
+        if not self.pending:
+            self.since = time.time()
+        self.pending.append(data)
+        self.size += len(data)
+        if self.size >= BATCH_SIZE:
+            self.flush()
+
+    def timeout(self):
+        # how long until pending output has to be written, None if there is none
+        if not self.pending:
+            return None
+        return max(0, self.since + FLUSH_INTERVAL - time.time())
+
+    def flush(self):
+        if self.pending:
+            self.stream.write("".join(self.pending))
+            self.stream.flush()
+            self.pending = []
+            self.size = 0
+
+
+# read whatever input is available in one go rather than line by line
+input_fd = input.fileno()
+output = BatchWriter(sys.stdout)
+remainder = ""
+try:
+    while True:
+        if not select.select([input_fd], [], [], output.timeout())[0]:
+            output.flush()
+            continue
+        chunk = os.read(input_fd, BATCH_SIZE)
+        if not chunk:
+            # end of input, like readline() returning a last line without newline
+            lines = [remainder, ""] if remainder else [""]
+        else:
+            lines = (remainder + chunk).split("\n")
+            remainder = lines.pop()
+            lines = [line + "\n" for line in lines]
+
+        for line in lines:
+            line = format_line(line)
+            if line is None: break
+            output.write(line + "\n")
+            if len(line) == 0: break
+        else:
+            if chunk: continue
+        break
+except KeyboardInterrupt:
+    pass
+output.flush()
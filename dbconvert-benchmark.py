@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+"""
+Benchmark the different transfer strategies of dbconvert.py.
+
+Generates a synthetic SQLite database of the requested size, then converts
+it into a fresh SQLite database once for each strategy, measuring the rows
+transferred per second and the peak memory usage (the combined resident
+memory of dbconvert.py and its worker processes, sampled from /proc while
+it runs). Everything runs locally, no database server is needed.
+
+Results are appended to a JSON lines file (--results), and each result is
+compared to the previous run of the same strategy with the same database
+parameters, so that regressions become visible over time:
+
+    ./dbconvert-benchmark.py --rows 200000 --width 10 --types int,text,date
+"""
+
+import optparse
+import os
+import sys
+import time
+import json
+import random
+import sqlite3
+import subprocess
+from os import path
+
+
+DBCONVERT = path.join(path.dirname(path.abspath(__file__)), 'dbconvert.py')
+
+# How often to sample the memory usage of a running strategy, in seconds.
+SAMPLE_INTERVAL = 0.05
+
+
+# Column type name: (SQL type, function returning a random value)
+COLUMN_TYPES = {
+    'int': ('INTEGER', lambda r: r.randint(-2**31, 2**31-1)),
+    'float': ('FLOAT', lambda r: r.random() * 10**6),
+    'numeric': ('NUMERIC(12, 2)', lambda r: '%d.%02d' % (
+        r.randint(0, 10**9), r.randint(0, 99))),
+    'text': ('VARCHAR(100)', lambda r: ''.join(
+        [r.choice('abcdefghijklmnopqrstuvwxyz ')
+         for i in range(r.randint(5, 100))])),
+    'date': ('DATETIME', lambda r: '20%02d-%02d-%02d %02d:%02d:%02d' % (
+        r.randint(0, 20), r.randint(1, 12), r.randint(1, 28),
+        r.randint(0, 23), r.randint(0, 59), r.randint(0, 59))),
+    'blob': ('BLOB', lambda r: buffer(''.join(
+        [chr(r.randint(0, 255)) for i in range(32)]))),
+}
+
+
+# Strategy name: dbconvert.py arguments
+STRATEGIES = [
+    ('orm-add', ['--orm']),
+    ('orm-merge', ['--orm', '--merge']),
+    ('core', []),
+    ('core-merge', ['--merge']),
+    ('pipelined', ['--pipeline']),
+    ('parallel', ['--jobs', '4', '--shards', '4', '--commit', '10000']),
+    ('bulk-load', ['--bulk-load']),
+]
+
+
+def generate_database(filename, num_rows, width, column_types, num_tables,
+                      seed=0):
+    """Create a SQLite database with ``num_tables`` tables of ``num_rows``
+    rows each. Every table has an integer primary key, plus ``width``
+    columns cycling through ``column_types``.
+    """
+    rand = random.Random(seed)
+    columns = [('col%d' % n, column_types[n % len(column_types)])
+               for n in range(width)]
+    db = sqlite3.connect(filename)
+    try:
+        for t in range(num_tables):
+            name = 'table%d' % t
+            db.execute('CREATE TABLE %s (id INTEGER PRIMARY KEY, %s)' % (
+                name, ', '.join(['%s %s' % (column, COLUMN_TYPES[type_][0])
+                                 for column, type_ in columns])))
+            insert = 'INSERT INTO %s VALUES (?, %s)' % (
+                name, ', '.join(['?'] * width))
+            generators = [COLUMN_TYPES[type_][1] for column, type_ in columns]
+            db.executemany(insert, (
+                [i] + [generate(rand) for generate in generators]
+                for i in xrange(1, num_rows+1)))
+        db.commit()
+    finally:
+        db.close()
+
+
+def process_tree(pid):
+    """The ids of ``pid`` and all of its descendants."""
+    children = {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % name).read()
+        except IOError:
+            continue  # exited in the meantime
+        # The command name may contain spaces and parentheses.
+        ppid = int(stat.rsplit(')', 1)[1].split()[1])
+        children.setdefault(ppid, []).append(int(name))
+    tree, pending = [], [pid]
+    while pending:
+        pid = pending.pop()
+        tree.append(pid)
+        pending.extend(children.get(pid, []))
+    return tree
+
+
+def tree_rss(pid):
+    """The combined resident memory of ``pid`` and its descendants, in
+    kilobytes.
+    """
+    page_kb = os.sysconf('SC_PAGE_SIZE') / 1024
+    total = 0
+    for member in process_tree(pid):
+        try:
+            total += int(open('/proc/%d/statm' % member).read().split()[1])
+        except IOError:
+            pass
+    return total * page_kb
+
+
+def run_strategy(source, target, arguments):
+    """Run dbconvert.py, returning the elapsed time in seconds and the
+    peak resident memory in kilobytes.
+
+    The memory usage of the whole process tree is sampled every
+    SAMPLE_INTERVAL seconds. Where /proc is not available, this falls
+    back to the peak of the largest single process.
+    """
+    if path.exists(target):
+        os.unlink(target)
+    sample = path.isdir('/proc')
+    peak = 0
+    devnull = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        process = subprocess.Popen(
+            [sys.executable, DBCONVERT] + arguments +
+            ['sqlite:///%s' % source, 'sqlite:///%s' % target],
+            stdout=devnull, stderr=devnull)
+        while True:
+            # Unlike Popen.poll(), this gives us the resource usage of the
+            # process and the workers it has waited for.
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid:
+                break
+            if sample:
+                peak = max(peak, tree_rss(process.pid))
+            time.sleep(SAMPLE_INTERVAL)
+        elapsed = time.time() - start
+    finally:
+        devnull.close()
+    if status != 0:
+        raise RuntimeError('dbconvert.py %s failed' % ' '.join(arguments))
+    # A short-lived peak may fall between two samples; no process tree
+    # uses less than its largest process.
+    return elapsed, max(peak, usage.ru_maxrss)
+
+
+def load_results(filename):
+    if not path.exists(filename):
+        return []
+    return [json.loads(line) for line in open(filename, 'r') if line.strip()]
+
+
+def previous_result(results, result):
+    """The most recent earlier result of the same benchmark, if any.
+    """
+    for candidate in reversed(results):
+        if candidate['strategy'] == result['strategy'] and \
+                candidate['parameters'] == result['parameters']:
+            return candidate
+    return None
+
+
+def git_revision():
+    try:
+        process = subprocess.Popen(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=path.dirname(DBCONVERT),
+            stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+        return process.communicate()[0].strip() or None
+    except OSError:
+        return None
+
+
+def parse_args(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--rows', type='int', default=100000, metavar='NUM',
+                      help='rows per table (default: %default)')
+    parser.add_option('--width', type='int', default=8, metavar='NUM',
+                      help='columns per table, besides the primary key '
+                           '(default: %default)')
+    parser.add_option('--types', default='int,text,float,date',
+                      help='comma separated list of column types to use, '
+                           'out of %s (default: %%default)' %
+                           ', '.join(sorted(COLUMN_TYPES)))
+    parser.add_option('--tables', type='int', default=4, metavar='NUM',
+                      help='number of tables (default: %default)')
+    parser.add_option('-s', '--strategy', dest='strategies', action='append',
+                      metavar='NAME',
+                      help='only run this strategy (can be given multiple '
+                           'times); one of %s' %
+                           ', '.join([name for name, args in STRATEGIES]))
+    parser.add_option('--repeat', type='int', default=1, metavar='NUM',
+                      help='run each strategy this many times, and keep '
+                           'the best (default: %default)')
+    parser.add_option('--workdir', default='dbconvert-benchmark',
+                      metavar='DIR',
+                      help='where to keep the generated databases '
+                           '(default: %default)')
+    parser.add_option('--results', default='dbconvert-benchmark.jsonl',
+                      metavar='FILE',
+                      help='file to append the results to '
+                           '(default: %default)')
+    parser.add_option('--threshold', type='float', default=10,
+                      metavar='PERCENT',
+                      help='report a strategy as a regression if it is '
+                           'this much slower than last time '
+                           '(default: %default)')
+    options, args = parser.parse_args(argv)
+    if args:
+        parser.error('unexpected arguments: %s' % ', '.join(args))
+
+    options.types = [t.strip() for t in options.types.split(',') if t.strip()]
+    for type_ in options.types:
+        if not type_ in COLUMN_TYPES:
+            parser.error('unknown column type: %s' % type_)
+    strategies = dict(STRATEGIES)
+    for name in options.strategies or []:
+        if not name in strategies:
+            parser.error('unknown strategy: %s' % name)
+    return options
+
+
+def main(argv):
+    options = parse_args(argv)
+    parameters = {
+        'rows': options.rows, 'width': options.width,
+        'types': options.types, 'tables': options.tables,
+    }
+
+    if not path.isdir(options.workdir):
+        os.makedirs(options.workdir)
+    source = path.join(options.workdir, 'source-%d-%d-%d-%s.db' % (
+        options.tables, options.rows, options.width, '-'.join(options.types)))
+    target = path.join(options.workdir, 'target.db')
+    if not path.exists(source):
+        print 'Generating %s' % source
+        generate_database(source + '.tmp', options.rows, options.width,
+                          options.types, options.tables)
+        os.rename(source + '.tmp', source)
+
+    results = load_results(options.results)
+    revision = git_revision()
+    total_rows = options.rows * options.tables
+    regressions = 0
+
+    print '%-12s %12s %12s   %s' % ('strategy', 'rows/s', 'peak RSS', 'change')
+    for name, arguments in STRATEGIES:
+        if options.strategies and not name in options.strategies:
+            continue
+        runs = [run_strategy(source, target, arguments)
+                for i in range(options.repeat)]
+        elapsed = min([e for e, rss in runs])
+        result = {
+            'time': time.time(),
+            'revision': revision,
+            'strategy': name,
+            'parameters': parameters,
+            'elapsed': elapsed,
+            'rows_per_sec': total_rows / elapsed,
+            'peak_rss_kb': max([rss for e, rss in runs]),
+        }
+
+        change = ''
+        previous = previous_result(results, result)
+        if previous:
+            percent = (result['rows_per_sec'] / previous['rows_per_sec'] - 1) * 100
+            change = '%+.1f%% vs. %s' % (percent, previous['revision'] or
+                time.strftime('%Y-%m-%d %H:%M', time.localtime(previous['time'])))
+            if percent < -options.threshold:
+                change += '  REGRESSION'
+                regressions += 1
+        print '%-12s %12.0f %9.1f MB   %s' % (
+            name, result['rows_per_sec'], result['peak_rss_kb'] / 1024.0,
+            change)
+
+        results.append(result)
+        f = open(options.results, 'a')
+        try:
+            f.write(json.dumps(result) + '\n')
+        finally:
+            f.close()
+
+    if path.exists(target):
+        os.unlink(target)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]) or 0)
@@ -2,12 +2,28 @@
 """This helps reconstructing a disk/snapshot hierarchy of a virtual machine,
 in case you lose it's config file, or your VirtualBox.xml file.
 
+Besides VDI, VMDK, VHD and QCOW2 images are understood as well, and may be
+mixed within one chain. Formats which link to their parent by filename
+rather than UUID (QCOW2, most VMDKs not created by VirtualBox) are matched
+against the other files given.
+
 Author: Michael Elsdoerfer <http://elsdoerfer.name>. Licensed under BSD.
 
 How to use this:
  - Use --detail to inspect VDI headers.
  - If your VirtualBox.xml file is lost, use --xml to generate xml code for the
    media registry part.
+ - Use --json to get the tree in a form other tools can process.
+ - Use --verify to check that the images of each chain fit together, e.g.
+   before attempting to restore a VM. With --sample, the data of some
+   blocks of each VDI image is read as well.
+ - Use --watch together with --scan to keep the tree of a datastore up to
+   date as images come and go (requires pyinotify). The current tree is
+   written to --output, and/or served to anyone connecting to --socket:
+      $ socat - UNIX-CONNECT:/tmp/vdi-tree.sock
+ - Use --analyze to see how much space each image uses, how fragmented it
+   is, and how many blocks of its parent a snapshot overrides; this helps
+   deciding which snapshots are worth merging.
  - If your VM specific xml is lost, it's thougher. The easiest way probably is:
       - Create a new machine with your base VDI.
       - Create snapshots matching the tree given by this script.
@@ -20,7 +36,36 @@ import sys, os
 import logging
 from os import path
 import optparse
-from struct import unpack
+import struct
+import stat
+import re
+import cPickle as pickle
+import sqlite3
+import threading
+import functools
+import mmap
+import array
+import json
+import time
+import random
+import hashlib
+import multiprocessing
+import SocketServer
+from cStringIO import StringIO
+from xml.sax.saxutils import quoteattr
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 
 logging.basicConfig(format='%(levelname)s: %(message)s')
@@ -35,10 +80,17 @@ VDI_TYPES = {
 
 
 class VDIHeader(object):
+    """The header of a disk image. Despite the name, this is used for all
+    supported formats; fields a format doesn't have are None.
+    """
+    format = 'VDI'
     version_minor = None
     version_major = None
     type = None
     flags = None
+    description = None
+    offset_blocks = None
+    offset_data = None
     size = None
     block_size = None
     num_blocks = None
@@ -46,6 +98,10 @@ class VDIHeader(object):
     uuid = None
     snapshot_uuid = None
     parent_uuid = None
+    parent_snapshot_uuid = None
+    # For formats which link to their parent by filename, relative to
+    # the directory of the image.
+    parent_filename = None
 
     def __repr__(self):
         return "<VDIHeader: %s>" % self.uuid
@@ -59,128 +115,525 @@ class VDIError(Exception):
     pass
 
 
+class IncompleteHeader(VDIError):
+    """The file is too short, or too empty, to tell yet; it may still be
+    in the process of being written.
+    """
 
-def read_int(f):
-    return unpack('<i', f.read(4))[0]
-
-def read_short(f):
-    return unpack('<h', f.read(2))[0]
-
-def read_long(f):
-    return unpack('<q', f.read(8))[0]
 
-def read_guid(f):
+VDI_SIGNATURE = '\x7f\x10\xda\xbe'
+
+# The pre-header (text and signature) and the version 1.1 header, up to
+# the last field we are interested in. Based on the format description
+# here: http://forums.virtualbox.org/viewtopic.php?t=8046
+VDI_HEADER = struct.Struct(
+    '<'
+    '64s'   # Text (plus what seems to be reserved space)
+    '4s'    # Signature
+    'hh'    # Version (minor, major)
+    'i'     # Size of header (0x190)
+    'i'     # Image type
+    'i'     # Flags
+    '256s'  # Description
+    'i'     # offsetBlocks
+    'i'     # offsetData
+    'iiii'  # Number of cylinders, heads, sectors; sector size
+    'i'     # Unused
+    'q'     # Disk size (in bytes)
+    'i'     # Block size
+    'i'     # Block extra data
+    'i'     # Total number of blocks
+    'i'     # Number of allocated blocks
+    '16s'   # uuid of disk
+    '16s'   # uuid of last snapshot
+    '16s'   # uuid of parent
+    '16s'   # uuid of parent's last snapshot
+)
+
+
+def decode_guid(data):
     # Only the first three fields seem to be stored in little-endian
-    fields = (f.read(4)[::-1], f.read(2)[::-1], f.read(2)[::-1], f.read(2), f.read(6))
-    if fields == ('\x00'*4, '\x00'*2, '\x00'*2, '\x00'*2, '\x00'*6):
+    if data == '\x00'*16:
         return None
+    fields = (data[3::-1], data[5:3:-1], data[7:5:-1], data[8:10], data[10:])
     return "%s-%s-%s-%s-%s" % tuple(map(lambda s: s.encode('hex'), fields))
 
 
-def parse_vdi_header(f):
-    """Based on format description here:
-    http://forums.virtualbox.org/viewtopic.php?t=8046
+def decode_vdi_header(data):
+    """Decode the header at the start of a VDI file, given as a string
+    of at least VDI_HEADER.size bytes.
     """
-    vdi = VDIHeader()
+    if len(data) < VDI_HEADER.size:
+        raise IncompleteHeader('truncated vdi header')
+    (text, signature, version_minor, version_major, header_size, type,
+     flags, description, offset_blocks, offset_data, cylinders, heads,
+     sectors, sector_size, unused, size, block_size, block_extra,
+     num_blocks, num_blocks_allocated, uuid, snapshot_uuid, parent_uuid,
+     parent_snapshot_uuid) = VDI_HEADER.unpack_from(data)
+
+    if signature != VDI_SIGNATURE:
+        raise VDIError('invalid signature')
+    if header_size != 0x190:
+        raise VDIError('unexpected header size')
+    if cylinders != 0:
+        raise VDIError('unexpected cylinder count')
+    if heads != 0:
+        raise VDIError('unexpected head count')
+    if sectors != 0:
+        raise VDIError('unexpected sector count')
+    if sector_size != 512:
+        raise VDIError('unexpected sector size')
+    if block_extra != 0:
+        raise VDIError('unexpected block extra data')
 
-    # Header
-    if f.read(33) != '<<< Sun VirtualBox Disk Image >>>':
-        raise VDIError('not a vdi file')
+    vdi = VDIHeader()
+    vdi.version_minor, vdi.version_major = version_minor, version_major
+    vdi.type = type
+    vdi.flags = flags
+    vdi.description = description.split('\x00', 1)[0]
+    vdi.offset_blocks = offset_blocks
+    vdi.offset_data = offset_data
+    vdi.size = size
+    vdi.block_size = block_size
+    vdi.num_blocks = num_blocks
+    vdi.num_blocks_allocated = num_blocks_allocated
+    vdi.uuid = decode_guid(uuid)
+    vdi.snapshot_uuid = decode_guid(snapshot_uuid)
+    vdi.parent_uuid = decode_guid(parent_uuid)
+    vdi.parent_snapshot_uuid = decode_guid(parent_snapshot_uuid)
+    return vdi
 
-    # Seems like reserved space
-    f.seek(f.tell()+31)
 
-    # signature
-    if f.read(4) != '\x7f\x10\xda\xbe':
-        raise VDIError('invalid signature')
+# Special values in the block map: a free block is read from the parent
+# image (or is all zero in a base image), a zero block is all zero
+# without being stored.
+VDI_BLOCK_FREE = 0xffffffff
+VDI_BLOCK_ZERO = 0xfffffffe
 
-    # Version
-    vdi.version_minor, vdi.version_major = read_short(f), read_short(f)
 
-    # Size of header (0x190)
-    if read_int(f) != 0x190:
-        raise VDIError('unexpected header size')
+def read_block_map(filename, header):
+    """Return the block map of a VDI image as an array of unsigned 32-bit
+    integers, one per block, giving the block's index in the data area.
+    """
+    end = header.offset_blocks + header.num_blocks * 4
+    f = open(filename, 'rb')
+    try:
+        try:
+            m = mmap.mmap(f.fileno(), end, access=mmap.ACCESS_READ)
+        except ValueError:
+            raise VDIError('file is too short for the block map')
+        try:
+            blocks = array.array('I', m[header.offset_blocks:end])
+        finally:
+            m.close()
+    finally:
+        f.close()
+    if sys.byteorder == 'big':
+        blocks.byteswap()
+    return blocks
 
-    # Image type
-    vdi.type = read_int(f)
 
-    # Flags
-    vdi.flags = read_int(f)
+def parse_vdi_header(f):
+    """Read the header from the VDI file ``f``, using a single read.
+    """
+    return decode_vdi_header(f.read(VDI_HEADER.size))
 
-    # Description (TODO: skip for now)
-    f.seek(f.tell()+256)
 
-    # offsetBlocks
-    read_int(f)
-    # offsetData
-    read_int(f)
-    # Number of cylinders
-    if read_int(f) != 0:
-        raise VDIError('unexpected cylinder count')
-    # Number of heads
-    if read_int(f) != 0:
-        raise VDIError('unexpected head count')
-    # Number of sectors
-    if read_int(f) != 0:
-        raise VDIError('unexpected sector count')
-    # Sector size
-    if read_int(f) != 512:
-        raise VDIError('unexpected sector size')
+# How much to read from the start of each file; enough for the formats to
+# be told apart, and for most headers to be parsed without another read.
+HEAD_SIZE = 4096
 
-    # Unused
-    read_int(f)
+# List of (offset, magic bytes, function); the function is called with
+# the open file and the data read from its start, and returns a VDIHeader,
+# or None if the file turns out not to be a disk image by itself.
+READERS = []
 
-    # Disk Size (in bytes)
-    vdi.size = read_long(f)
 
-    # Block Size
-    vdi.block_size = read_int(f)
-    # Block Extra Data
-    if read_int(f) != 0:
-        raise VDIError('unexpected block extra data')
-
-    # Total number of blocks
-    vdi.num_blocks = read_int(f)
-    # Number of allocated blocks
-    vdi.num_blocks_allocated = read_int(f)
+def reader(magic, offset=0):
+    """Register the decorated function as the reader for files with
+    ``magic`` at ``offset``.
+    """
+    def decorator(func):
+        READERS.append((offset, magic, func))
+        return func
+    return decorator
 
-    # uuid of disk
-    vdi.uuid = read_guid(f)
-    # uuid of last snapshot
-    vdi.snapshot_uuid = read_guid(f)
-    # uuid of parent
-    vdi.parent_uuid = read_guid(f)
 
+def read_at(f, head, offset, size):
+    """Return ``size`` bytes at ``offset``, from ``head`` if possible.
+    """
+    if offset + size <= len(head):
+        return head[offset:offset+size]
+    f.seek(offset)
+    return f.read(size)
+
+
+@reader(VDI_SIGNATURE, offset=64)
+def read_vdi_header(f, head):
+    vdi = decode_vdi_header(head)
+    if vdi.version_str != '1.1':
+        raise VDIError("only version 1.1. is supported, this is %s" % vdi.version_str)
+    if not vdi.type in (1, 2, 4):
+        # All that is needed to support other types is finding the correct id mappings,
+        # then generationg the proper xml format="" attribute.
+        raise VDIError("Unsupported image type")
     return vdi
 
 
-def read_vdis(filenames):
-    """Read the headers of a list of VDI images.
+VHD_FOOTER = struct.Struct(
+    '>'
+    '8s'    # Cookie ("conectix")
+    'I'     # Features
+    'I'     # Format version
+    'Q'     # Data offset (of the dynamic disk header)
+    'I'     # Timestamp
+    '4s'    # Creator application
+    'I'     # Creator version
+    '4s'    # Creator host OS
+    'Q'     # Original size
+    'Q'     # Current size
+    'I'     # Disk geometry
+    'I'     # Disk type
+    'I'     # Checksum
+    '16s'   # Unique id
+)
+
+VHD_DYNAMIC_HEADER = struct.Struct(
+    '>'
+    '8s'    # Cookie ("cxsparse")
+    'Q'     # Data offset (unused)
+    'Q'     # Block allocation table offset
+    'I'     # Header version
+    'I'     # Max. table entries
+    'I'     # Block size
+    'I'     # Checksum
+    '16s'   # Parent unique id
+    'I'     # Parent timestamp
+    '4s'    # Reserved
+    '512s'  # Parent unicode name (UTF-16BE)
+)
+
+# VHD disk type: VDI type
+VHD_TYPES = {2: 2, 3: 1, 4: 4}
+
+
+def decode_vhd_footer(f, head, footer):
+    (cookie, features, version, data_offset, timestamp, creator_app,
+     creator_version, creator_host, original_size, current_size, geometry,
+     disk_type, checksum, uuid) = VHD_FOOTER.unpack_from(footer)
+    if not disk_type in VHD_TYPES:
+        raise VDIError('unsupported VHD disk type %d' % disk_type)
+
+    vhd = VDIHeader()
+    vhd.format = 'VHD'
+    vhd.version_major, vhd.version_minor = version >> 16, version & 0xffff
+    vhd.type = VHD_TYPES[disk_type]
+    vhd.size = current_size
+    # VirtualBox treats the ids like its own UUIDs
+    vhd.uuid = decode_guid(uuid)
+    if disk_type != 2:
+        data = read_at(f, head, data_offset, VHD_DYNAMIC_HEADER.size)
+        if len(data) < VHD_DYNAMIC_HEADER.size:
+            raise IncompleteHeader('truncated dynamic disk header')
+        (cookie, unused, table_offset, header_version, max_entries,
+         block_size, checksum, parent_uuid, parent_timestamp, reserved,
+         parent_name) = VHD_DYNAMIC_HEADER.unpack(data)
+        if cookie != 'cxsparse':
+            raise VDIError('invalid dynamic disk header')
+        vhd.block_size = block_size
+        vhd.num_blocks = max_entries
+        if disk_type == 4:
+            vhd.parent_uuid = decode_guid(parent_uuid)
+            vhd.parent_filename = parent_name.decode('utf-16-be', 'replace') \
+                .split(u'\x00', 1)[0].encode(sys.getfilesystemencoding() or 'utf-8') or None
+    return vhd
+
+
+@reader('conectix')
+def read_vhd_header(f, head):
+    # Dynamic and differencing disks have a copy of the footer at the start
+    return decode_vhd_footer(f, head, head[:VHD_FOOTER.size])
+
+
+def read_fixed_vhd_header(f, head):
+    """Fixed disks only have the footer at the end of the file; this is
+    only tried for files with a .vhd extension.
     """
-    vdis = {}
-    for filename in filenames:
-        if path.isdir(filename):
-            log.error('%s: is a directory', filename)
-            continue
+    f.seek(-512, os.SEEK_END)
+    footer = f.read(512)
+    if not footer.startswith('conectix'):
+        return None
+    return decode_vhd_footer(f, head, footer)
+
+
+QCOW2_HEADER = struct.Struct(
+    '>'
+    '4s'    # Magic ("QFI\xfb")
+    'I'     # Version
+    'Q'     # Backing file name offset
+    'I'     # Backing file name size
+    'I'     # Cluster bits
+    'Q'     # Size
+)
+
+
+@reader('QFI\xfb')
+def read_qcow2_header(f, head):
+    if len(head) < QCOW2_HEADER.size:
+        raise IncompleteHeader('truncated qcow header')
+    (magic, version, backing_offset, backing_size, cluster_bits,
+     size) = QCOW2_HEADER.unpack_from(head)
+    if not version in (2, 3):
+        raise VDIError('only qcow2 (version 2 and 3) is supported, this is %d' % version)
+
+    qcow = VDIHeader()
+    qcow.format = 'QCOW2'
+    qcow.version_major, qcow.version_minor = version, 0
+    qcow.size = size
+    qcow.block_size = 1 << cluster_bits
+    qcow.type = 1
+    if backing_offset:
+        qcow.type = 4
+        qcow.parent_filename = read_at(f, head, backing_offset, backing_size)
+    return qcow
+
+
+VMDK_SPARSE_HEADER = struct.Struct(
+    '<'
+    '4s'    # Magic ("KDMV")
+    'I'     # Version
+    'I'     # Flags
+    'Q'     # Capacity (in sectors)
+    'Q'     # Grain size (in sectors)
+    'Q'     # Descriptor offset (in sectors)
+    'Q'     # Descriptor size (in sectors)
+)
+
+VMDK_EXTENT = re.compile(r'^(RW|RDONLY|NOACCESS)\s+(\d+)\s+\S+')
+VMDK_NULL_UUID = '00000000-0000-0000-0000-000000000000'
+
+
+def parse_vmdk_descriptor(text, vmdk):
+    """Fill in ``vmdk`` from the text of a VMDK descriptor.
+    """
+    values = {}
+    size = 0
+    for line in text.splitlines():
+        line = line.strip()
+        match = VMDK_EXTENT.match(line)
+        if match:
+            size += int(match.group(2)) * 512
+        elif '=' in line and not line.startswith('#'):
+            key, value = line.split('=', 1)
+            values[key.strip()] = value.strip().strip('"')
+
+    vmdk.format = 'VMDK'
+    vmdk.description = values.get('createType')
+    vmdk.size = vmdk.size or size
+    vmdk.uuid = values.get('ddb.uuid.image')
+    has_parent = values.get('parentCID', 'ffffffff').lower() != 'ffffffff'
+    if has_parent:
+        vmdk.type = 4
+        if values.get('ddb.uuid.parent', VMDK_NULL_UUID) != VMDK_NULL_UUID:
+            vmdk.parent_uuid = values['ddb.uuid.parent']
+        vmdk.parent_filename = values.get('parentFileNameHint')
+    elif 'flat' in values.get('createType', '').lower():
+        vmdk.type = 2
+    else:
+        vmdk.type = 1
+    return vmdk
+
+
+@reader('KDMV')
+def read_vmdk_sparse_header(f, head):
+    if len(head) < VMDK_SPARSE_HEADER.size:
+        raise IncompleteHeader('truncated vmdk header')
+    (magic, version, flags, capacity, grain_size, descriptor_offset,
+     descriptor_size) = VMDK_SPARSE_HEADER.unpack_from(head)
+    if not descriptor_offset:
+        # One extent of a disk which is described by a separate file
+        return None
+    vmdk = VDIHeader()
+    vmdk.version_major, vmdk.version_minor = version, 0
+    vmdk.size = capacity * 512
+    vmdk.block_size = grain_size * 512
+    text = read_at(f, head, descriptor_offset * 512, descriptor_size * 512)
+    return parse_vmdk_descriptor(text.split('\x00', 1)[0], vmdk)
+
+
+@reader('# Disk DescriptorFile')
+def read_vmdk_descriptor(f, head):
+    text = head
+    if len(head) == HEAD_SIZE:
+        # Descriptors are usually small, but may list many extents
+        text += f.read(1024*1024)
+    return parse_vmdk_descriptor(text, VDIHeader())
+
+
+def read_header(filename):
+    """Read the header of the disk image ``filename``, in whatever
+    format it is. Returns None if it is not a disk image, and raises
+    IncompleteHeader if nothing has been written to its start yet.
+    """
+    f = open(filename, 'rb')
+    try:
+        head = f.read(HEAD_SIZE)
+        if not head.strip('\x00') or \
+                len(head) < max([o + len(m) for o, m, func in READERS]):
+            raise IncompleteHeader('not a supported disk image, or not written yet')
+        for offset, magic, func in READERS:
+            if head[offset:offset+len(magic)] == magic:
+                return func(f, head)
+        if filename.lower().endswith('.vhd') and len(head) >= 512:
+            return read_fixed_vhd_header(f, head)
+        return None
+    finally:
+        f.close()
 
-        f = open(filename, 'r')
-        try:
-            vdi = parse_vdi_header(f)
-        except VDIError:
-            log.error("%s: not a vdi file", filename)
-            continue
 
-        if vdi.version_str != '1.1':
-            log.error("%s: only version 1.1. is supported, this is %s", filename, vdi.version_str)
+def scan_directories(directories):
+    """Yield the paths of all regular files below ``directories``.
+    Symbolic links are not followed.
+    """
+    for directory in directories:
+        if scandir is None:
+            for dirpath, dirnames, filenames in os.walk(directory):
+                for filename in filenames:
+                    filename = path.join(dirpath, filename)
+                    if path.isfile(filename) and not path.islink(filename):
+                        yield filename
             continue
 
-        if not vdi.type in (1, 2, 4):
-            # All that is needed to support other types is finding the correct id mappings,
-            # then generationg the proper xml format="" attribute.
-            log.error("%s: Unsupported image type" % filename)
-            continue
+        pending = [directory]
+        while pending:
+            try:
+                entries = scandir(pending.pop())
+            except OSError, e:
+                log.error('%s: %s', e.filename, e.strerror)
+                continue
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.path
+
+
+class HeaderCache(object):
+    """Remembers the header parsed from each file in a SQLite database,
+    so that a rerun over unchanged files only needs to stat them. Entries
+    are keyed by device and inode, and are used only if size and mtime
+    still match.
+
+    Files which turned out not to be disk images are remembered as well;
+    files with invalid headers are not, so the error is reported again.
+    """
 
-        vdis[filename] = vdi
+    def __init__(self, filename):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS image_headers ('
+                        'dev INTEGER, ino INTEGER, size INTEGER, mtime REAL, '
+                        'header BLOB, PRIMARY KEY (dev, ino))')
+        self.lock = threading.Lock()
+
+    def get(self, st):
+        """Return (found, header); header is None for files which are
+        not disk images.
+        """
+        with self.lock:
+            row = self.db.execute(
+                'SELECT header FROM image_headers WHERE dev=? AND ino=? '
+                'AND size=? AND mtime=?',
+                (st.st_dev, st.st_ino, st.st_size, st.st_mtime)).fetchone()
+        if not row:
+            return False, None
+        if not row[0]:
+            return True, None
+        header = VDIHeader()
+        header.__dict__.update(pickle.loads(str(row[0])))
+        return True, header
+
+    def put(self, st, header):
+        data = pickle.dumps(vars(header), 2) if header else ''
+        with self.lock:
+            self.db.execute(
+                'INSERT OR REPLACE INTO image_headers VALUES (?, ?, ?, ?, ?)',
+                (st.st_dev, st.st_ino, st.st_size, st.st_mtime,
+                 sqlite3.Binary(data)))
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+def read_vdi(filename, scanning=False, cache=None, incomplete=None):
+    """Read the header of a single disk image; returns a (filename,
+    header) tuple, with header being None if the file could not be used.
+
+    When ``scanning``, files which are not disk images at all, or not yet,
+    are skipped silently. ``cache`` is an optional HeaderCache.
+    ``incomplete`` is an optional set, which is kept up to date with the
+    files whose header has not been completely written yet.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError, e:
+        log.error('%s: %s', filename, e.strerror)
+        return filename, None
+    if stat.S_ISDIR(st.st_mode):
+        log.error('%s: is a directory', filename)
+        return filename, None
+
+    found, vdi = cache.get(st) if cache else (False, None)
+    if not found:
+        try:
+            vdi = read_header(filename)
+        except IOError, e:
+            log.error('%s: %s', filename, e.strerror)
+            return filename, None
+        except IncompleteHeader, e:
+            # Neither cached nor reported as not a disk image, so that the
+            # file can be read again once it has been written.
+            if incomplete is not None:
+                incomplete.add(filename)
+            if not scanning:
+                log.error('%s: %s', filename, e)
+            return filename, None
+        except VDIError, e:
+            log.error('%s: %s', filename, e)
+            return filename, None
+        if cache:
+            cache.put(st, vdi)
+
+    if incomplete is not None:
+        incomplete.discard(filename)
+    if not vdi and not scanning:
+        log.error("%s: not a supported disk image", filename)
+    return filename, vdi
+
+
+def read_vdis(filenames, scanning=False, threads=1, cache=None,
+              incomplete=None):
+    """Read the headers of a list of disk images, using up to ``threads``
+    concurrent reads; headers are small, so this is all I/O latency.
+
+    ``filenames`` may be any iterable, e.g. scan_directories().
+    """
+    vdis = {}
+    pool = ThreadPool(threads)
+    try:
+        read = functools.partial(read_vdi, scanning=scanning, cache=cache,
+                                 incomplete=incomplete)
+        for filename, vdi in pool.imap_unordered(read, filenames, 16):
+            if vdi:
+                vdis[filename] = vdi
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
     return vdis
 
 
@@ -195,49 +648,143 @@ class VDI(object):
 
     @property
     def uuid(self):
-        return self._uuid if self._uuid else self.h.uuid
+        return self._uuid if self._uuid or not self.h else self.h.uuid
+
+    @property
+    def name(self):
+        if self.h:
+            return self.filename
+        return '%s (not found)' % self.filename if self.filename else '(not found)'
 
 
 def construct_tree(vdis):
     """Take a list of VDIs, try to build a tree.
     """
-    vdis = [VDI(filename, vdi) for filename, vdi in vdis.items()]
-    non_root = []
-    for current in vdis:
-       for candidate in vdis:
-          if current == candidate:
-              continue
-          if current.header.parent_uuid == candidate.header.uuid:
-              non_root.append(current)
-              candidate.children.append(current)
-    tree = [v for v in vdis if not v in non_root]
+    vdis = [VDI(filename, vdis[filename]) for filename in sorted(vdis)]
+    by_uuid = {}
+    by_filename = {}
+    for vdi in vdis:
+        # If multiple files share a UUID (e.g. copies), children are
+        # attached to the first one.
+        if vdi.uuid:
+            by_uuid.setdefault(vdi.uuid, vdi)
+        by_filename[path.abspath(vdi.filename)] = vdi
+
+    tree = []
     # Some VDIs may refer to a parent that we were not able to find. Construct
-    # a special not found VDI record as their parent node.
-    tree = [rn if rn.h.parent_uuid is None else VDI(None, None, uuid=rn.h.parent_uuid, children=[rn]) for rn in tree]
+    # a special not found VDI record as their parent node, shared by all
+    # children of the same missing parent.
+    missing = {}
+    parents = {}
+    for vdi in vdis:
+        parent_uuid = vdi.h.parent_uuid
+        parent_filename = None
+        if vdi.h.parent_filename:
+            parent_filename = path.abspath(path.join(
+                path.dirname(vdi.filename), vdi.h.parent_filename))
+        parent = by_uuid.get(parent_uuid) or by_filename.get(parent_filename)
+        if parent is vdi:
+            log.warning('%s: refers to itself as its parent', vdi.filename)
+            tree.append(vdi)
+        elif parent:
+            parent.children.append(vdi)
+            parents[vdi] = parent
+        elif parent_uuid or parent_filename:
+            key = parent_uuid or parent_filename
+            if not key in missing:
+                if parent_uuid:
+                    missing[key] = VDI(None, None, uuid=parent_uuid)
+                else:
+                    missing[key] = VDI(parent_filename, None)
+                tree.append(missing[key])
+            missing[key].children.append(vdi)
+        else:
+            tree.append(vdi)
+
+    # Images whose parents form a cycle are not reachable from any root.
+    # Break the cycle above each of them, and list them as orphans.
+    reached = set()
+    def reach(pending):
+        while pending:
+            node = pending.pop()
+            reached.add(node)
+            pending.extend(node.children)
+    reach(list(tree))
+    for vdi in vdis:
+        if not vdi in reached:
+            log.warning('%s: parent chain forms a cycle', vdi.filename)
+            parents[vdi].children.remove(vdi)
+            tree.append(vdi)
+            reach([vdi])
     return tree
 
 
-def walk_tree(tree, func, start=0, indentation=' '*2):
-    """Call ``func`` for every node in the tree.
+class OutputBuffer(object):
+    """Collects output, and writes it to ``stream`` in large chunks
+    rather than line by line.
+    """
+
+    def __init__(self, stream=None, chunk_size=64*1024):
+        self.stream = stream or sys.stdout
+        self.chunk_size = chunk_size
+        self.parts = []
+        self.size = 0
+
+    def write(self, data):
+        self.parts.append(data)
+        self.size += len(data)
+        if self.size >= self.chunk_size:
+            self.flush()
 
-    ``func`` takes (node, level) and should return (before, after).
+    def flush(self):
+        self.stream.write(''.join(self.parts))
+        self.stream.flush()
+        self.parts = []
+        self.size = 0
+
+
+def iter_tree(tree):
+    """Yield (node, level, entering) for every node in the tree, once
+    when entering the node (before its children) and once when leaving
+    it (after its children).
+
+    This does not recurse, so there is no limit to how deep the tree
+    may be.
     """
-    def handle_node(node, level):
-        def _print(what):
-            if what:
-                for line in what if isinstance(what, list) else [what]:
-                    print "%s%s" % (indentation*level, line)
+    pending = [(node, 0, True) for node in reversed(tree)]
+    while pending:
+        node, level, entering = pending.pop()
+        yield node, level, entering
+        if entering:
+            pending.append((node, level, False))
+            pending.extend([(child, level+1, True) for child in reversed(node.children)])
+
 
-        before, after = func(node)
-        _print(before)
-        for c in node.children:
-            handle_node(c, level+1)
-        _print(after)
-    for root in tree:
-        handle_node(root, start)
+def walk_tree(tree, func, start=0, indentation=' '*2, out=None):
+    """Call ``func`` for every node in the tree, and write the lines it
+    returns to ``out`` (an OutputBuffer), indented by level.
+
+    ``func`` takes (node) and should return (before, after).
+    """
+    buffer = out or OutputBuffer()
+    def _print(what, level):
+        if what:
+            for line in what if isinstance(what, list) else [what]:
+                buffer.write("%s%s\n" % (indentation*level, line))
+
+    afters = []
+    for node, level, entering in iter_tree(tree):
+        if entering:
+            before, after = func(node)
+            _print(before, start+level)
+            afters.append(after)
+        else:
+            _print(afters.pop(), start+level)
+    if not out:
+        buffer.flush()
 
 
-def print_info(tree, detailed=False):
+def print_info(tree, detailed=False, stream=None):
     """Print VDI info in a format more easily readable than XML.
     """
     if len(tree) == 1 and not tree[0].children:
@@ -245,53 +792,591 @@ def print_info(tree, detailed=False):
         detailed = True
 
     def p(node):
-        filename = node.filename or '(not found)'
         if not detailed:
-            start = '%s [UUID: %s]' % (filename, node.uuid)
+            start = '%s [UUID: %s]' % (node.name, node.uuid) if node.uuid else node.name
         else:
-            start = ['- %s' % node.uuid]
-            start.append('  '+'-'*len(node.uuid))
-            start.append('  Filename: %s' % filename)
+            title = node.uuid or path.basename(node.filename)
+            start = ['- %s' % title]
+            start.append('  '+'-'*len(title))
+            start.append('  Filename: %s' % node.name)
             if node.h:
+                start.append('  Format: %s' % node.h.format)
                 start.append('  Type: %s' % VDI_TYPES.get(node.h.type, '??'))
-                start.append('  Last snapshot: %s' % node.h.snapshot_uuid)
+                if node.h.description:
+                    start.append('  Description: %s' % node.h.description)
+                if node.h.snapshot_uuid:
+                    start.append('  Last snapshot: %s' % node.h.snapshot_uuid)
                 start.append('  Size: %s bytes' % node.h.size)
             start.append('')
 
         return start, None
-    walk_tree(tree, p, start=0, indentation=' '*4)
+    out = OutputBuffer(stream)
+    walk_tree(tree, p, start=0, indentation=' '*4, out=out)
+    out.flush()
+
+
+def block_map_stats(blocks, parent_blocks=None):
+    """Summarize a block map.
+
+    Allocated blocks are grouped into extents of blocks which are
+    adjacent both in the disk and in the file; the more extents there are,
+    the more a sequential read of the disk has to seek. If the map of the
+    parent image is given, also count the blocks the image overrides.
+    """
+    free = blocks.count(VDI_BLOCK_FREE)
+    zero = blocks.count(VDI_BLOCK_ZERO)
+    extents = 0
+    previous = None
+    for block in blocks:
+        if block >= VDI_BLOCK_ZERO:
+            previous = None
+            continue
+        if previous is None or block != previous + 1:
+            extents += 1
+        previous = block
+
+    stats = {
+        'blocks': len(blocks),
+        'allocated': len(blocks) - free - zero,
+        'zero': zero,
+        'extents': extents,
+        'overrides': None,
+    }
+    if parent_blocks is not None and len(parent_blocks) == len(blocks):
+        stats['overrides'] = sum([1 for block, parent in izip(blocks, parent_blocks)
+                                  if block != VDI_BLOCK_FREE and parent != VDI_BLOCK_FREE])
+    return stats
+
+
+def analyze_tree(tree):
+    """Return a dict mapping each node of the tree for which the block
+    map could be read to the result of block_map_stats().
+    """
+    analysis = {}
+    # Walk depth first, keeping a parent's block map only as long as
+    # its children still need it.
+    pending = [(node, None) for node in reversed(tree)]
+    while pending:
+        node, parent_blocks = pending.pop()
+        blocks = None
+        if node.h and node.h.format == 'VDI':
+            try:
+                blocks = read_block_map(node.filename, node.h)
+            except (VDIError, EnvironmentError), e:
+                log.error('%s: cannot read block map: %s', node.filename, e)
+            else:
+                analysis[node] = block_map_stats(blocks, parent_blocks)
+        for child in reversed(node.children):
+            same_blocks = blocks is not None and child.h.block_size == node.h.block_size
+            pending.append((child, blocks if same_blocks else None))
+    return analysis
+
+
+def format_size(num_bytes):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if num_bytes < 1024:
+            break
+        num_bytes /= 1024.0
+    else:
+        unit = 'TB'
+    return ('%d %s' if unit == 'bytes' else '%.1f %s') % (num_bytes, unit)
 
 
-def print_diskmgmt_xml(tree):
+def print_analysis(tree, stream=None):
+    """Print the block usage of each image.
+    """
+    analysis = analyze_tree(tree)
+
+    def p(node):
+        lines = ['%s [UUID: %s]' % (node.name, node.uuid) if node.uuid else node.name]
+        stats = analysis.get(node)
+        if stats:
+            block_size = node.h.block_size
+            allocated = stats['allocated']
+            lines.append('  %d blocks of %s, %d allocated (%s, %d%%), %d zero' % (
+                stats['blocks'], format_size(block_size), allocated,
+                format_size(allocated * block_size),
+                100 * allocated / max(stats['blocks'], 1), stats['zero']))
+            lines.append('  %d extents, fragmentation %d%%' % (
+                stats['extents'],
+                100 * (stats['extents'] - 1) / (allocated - 1) if allocated > 1 else 0))
+            if stats['overrides'] is not None:
+                lines.append('  Overrides %d blocks of its parent (%s)' % (
+                    stats['overrides'], format_size(stats['overrides'] * block_size)))
+        return lines, None
+    out = OutputBuffer(stream)
+    walk_tree(tree, p, start=0, indentation=' '*4, out=out)
+    out.flush()
+
+
+def decode_filename(filename):
+    if filename is None:
+        return None
+    return filename.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+
+
+# Our format names, where VirtualBox uses a different one
+XML_FORMATS = {'QCOW2': 'QCOW'}
+
+
+def print_diskmgmt_xml(tree, stream=None):
     """Print the XML for use in the VirtualBox.xml file.
     """
-    print "<MediaRegistry>"
+    out = OutputBuffer(stream)
+    out.write("<MediaRegistry>\n")
     def p(node):
-        open_tag = '<HardDisk uuid="%s" location="%s" format="VDI">' % (node.uuid, node.filename or '(not found)')
+        # For missing parents, assume the format of the children
+        format = (node.h or node.children[0].h).format
+        open_tag = '<HardDisk uuid=%s location=%s format=%s>' % (
+            quoteattr(node.uuid or ''),
+            quoteattr(decode_filename(node.filename) or '(not found)').encode('utf-8'),
+            quoteattr(XML_FORMATS.get(format, format)))
         return open_tag, "</HardDisk>"
-    walk_tree(tree, p, start=1)
-    print "</MediaRegistry>"
+    walk_tree(tree, p, start=1, out=out)
+    out.write("</MediaRegistry>\n")
+    out.flush()
+
+
+def node_record(node):
+    """The information about a node to include in the JSON output.
+    """
+    record = {'uuid': node.uuid, 'filename': decode_filename(node.filename)}
+    if node.h:
+        record.update({
+            'format': node.h.format,
+            'type': VDI_TYPES.get(node.h.type),
+            'description': (node.h.description or '').decode('utf-8', 'replace'),
+            'size': node.h.size,
+            'block_size': node.h.block_size,
+            'snapshot_uuid': node.h.snapshot_uuid,
+            'parent_uuid': node.h.parent_uuid,
+            'parent_filename': decode_filename(node.h.parent_filename),
+        })
+    return record
+
+
+def print_json(tree, stream=None):
+    """Print the tree as a JSON list of nested objects, each with a
+    "children" list.
+    """
+    out = OutputBuffer(stream)
+    out.write('[')
+    first = True
+    for node, level, entering in iter_tree(tree):
+        if entering:
+            if not first:
+                out.write(', ')
+            # Leave the object open, the children are added to it
+            out.write(json.dumps(node_record(node), sort_keys=True)[:-1])
+            out.write(', "children": [')
+            first = True
+        else:
+            out.write(']}')
+            first = False
+    out.write(']\n')
+    out.flush()
+
+
+def check_block_map(filename, header, blocks):
+    """Return a list of problems with the block map of a VDI image.
+    """
+    problems = []
+    if header.num_blocks * header.block_size < header.size:
+        problems.append('%d blocks of %d bytes are less than the disk size of %d bytes' % (
+            header.num_blocks, header.block_size, header.size))
+    allocated = [block for block in blocks if block < VDI_BLOCK_ZERO]
+    if len(allocated) != header.num_blocks_allocated:
+        problems.append('header says %d blocks are allocated, the block map has %d' % (
+            header.num_blocks_allocated, len(allocated)))
+    beyond = len([block for block in allocated if block >= header.num_blocks_allocated])
+    if beyond:
+        problems.append('%d blocks are mapped beyond the allocated blocks' % beyond)
+    if len(set(allocated)) != len(allocated):
+        problems.append('%d blocks share their data with another block' % (
+            len(allocated) - len(set(allocated))))
+    expected = header.offset_data + header.num_blocks_allocated * header.block_size
+    actual = os.path.getsize(filename)
+    if actual < expected:
+        problems.append('file is truncated, it has %d bytes instead of %d' % (actual, expected))
+    return problems
+
+
+def hash_block(job):
+    """Return the SHA-1 of ``length`` bytes at ``offset`` in ``filename``,
+    or None if they cannot be read. Only the block is mapped, not the
+    whole file.
+    """
+    filename, offset, length = job
+    try:
+        f = open(filename, 'rb')
+        try:
+            if os.fstat(f.fileno()).st_size < offset + length:
+                return None
+            start = offset - offset % mmap.ALLOCATIONGRANULARITY
+            m = mmap.mmap(f.fileno(), offset + length - start,
+                          access=mmap.ACCESS_READ, offset=start)
+            try:
+                return hashlib.sha1(buffer(m, offset - start, length)).hexdigest()
+            finally:
+                m.close()
+        finally:
+            f.close()
+    except EnvironmentError:
+        return None
+
+
+def verify_tree(tree, sample=0, processes=None):
+    """Check each chain of the tree, returning a list of
+    (node, problem) tuples.
+
+    Children are checked against their parent: disk size, block size and
+    the parent's snapshot UUID must match. For VDI images, the block map
+    is checked as well. If ``sample`` is given, that many allocated blocks
+    of each VDI image are read and hashed (in a pool of ``processes``);
+    if the parent has the same block allocated, it is hashed as well to
+    find blocks the child stores needlessly.
+    """
+    problems = []
+    jobs = []
+    comparisons = []
+    pending = [(node, None, None) for node in reversed(tree)]
+    while pending:
+        node, parent, parent_blocks = pending.pop()
+        blocks = None
+        if not node.h:
+            problems.extend([(child, 'parent %s not found' % (node.uuid or node.filename))
+                             for child in node.children])
+        elif parent:
+            h, ph = node.h, parent.h
+            if h.size != ph.size:
+                problems.append((node, 'disk size %d differs from the parent\'s %d' % (
+                    h.size, ph.size)))
+            if h.format == ph.format and h.block_size and ph.block_size and \
+                    h.block_size != ph.block_size:
+                problems.append((node, 'block size %s differs from the parent\'s %s' % (
+                    h.block_size, ph.block_size)))
+            if h.parent_snapshot_uuid and ph.snapshot_uuid and \
+                    h.parent_snapshot_uuid != ph.snapshot_uuid:
+                problems.append((node, 'expects parent snapshot %s, but the parent\'s last snapshot is %s' % (
+                    h.parent_snapshot_uuid, ph.snapshot_uuid)))
+
+        if node.h and node.h.format == 'VDI':
+            try:
+                blocks = read_block_map(node.filename, node.h)
+                problems.extend([(node, problem) for problem in
+                                 check_block_map(node.filename, node.h, blocks)])
+            except (VDIError, EnvironmentError), e:
+                problems.append((node, 'cannot read block map: %s' % e))
+                blocks = None
+
+        if blocks is not None and sample:
+            allocated = [index for index, block in enumerate(blocks)
+                         if block < node.h.num_blocks_allocated]
+            for index in random.sample(allocated, min(sample, len(allocated))):
+                job = (node.filename, node.h.offset_data + blocks[index] * node.h.block_size,
+                       node.h.block_size)
+                jobs.append((node, job))
+                # The parent may be smaller, which is reported above
+                if parent_blocks is not None and index < len(parent_blocks) and \
+                        parent_blocks[index] < parent.h.num_blocks_allocated:
+                    parent_job = (parent.filename, parent.h.offset_data +
+                                  parent_blocks[index] * parent.h.block_size,
+                                  parent.h.block_size)
+                    comparisons.append((node, len(jobs) - 1, len(jobs)))
+                    jobs.append((parent, parent_job))
+
+        for child in reversed(node.children):
+            same_blocks = blocks is not None and child.h.format == 'VDI' and \
+                child.h.block_size == node.h.block_size
+            pending.append((child, node if node.h else None,
+                            blocks if same_blocks else None))
+
+    if jobs:
+        pool = multiprocessing.Pool(processes)
+        try:
+            digests = pool.map(hash_block, [job for node, job in jobs], 8)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+        unreadable = {}
+        for (node, job), digest in izip(jobs, digests):
+            if digest is None:
+                unreadable[node] = unreadable.get(node, 0) + 1
+        for node, count in unreadable.iteritems():
+            problems.append((node, '%d sampled blocks could not be read' % count))
+        identical = {}
+        for node, index, parent_index in comparisons:
+            if digests[index] and digests[index] == digests[parent_index]:
+                identical[node] = identical.get(node, 0) + 1
+        for node, count in identical.iteritems():
+            log.warning('%s: %d sampled blocks are identical to the parent\'s',
+                        node.filename, count)
+    return problems
+
+
+def print_verification(tree, sample=0, processes=None, stream=None):
+    """Print the problems found by verify_tree(); returns the exit code.
+    """
+    problems = verify_tree(tree, sample, processes)
+    out = OutputBuffer(stream)
+    for node, problem in problems:
+        out.write('%s: %s\n' % (node.name, problem))
+    num_images = len([node for node, level, entering in iter_tree(tree)
+                      if entering and node.h])
+    out.write('%d images checked, %d problems found\n' % (num_images, len(problems)))
+    out.flush()
+    return 2 if problems else 0
+
+
+class VDIIndex(object):
+    """Keeps the headers of all disk images below a set of directories,
+    so that the tree can be rebuilt without reading any files as
+    individual files and directories change.
+
+    All paths are made absolute, as inotify reports them.
+    """
+
+    def __init__(self, directories, threads=1, cache=None):
+        self.directories = [path.abspath(d) for d in directories]
+        self.threads = threads
+        self.cache = cache
+        self.vdis = {}
+        # Files which may still become disk images as they are written
+        self.incomplete = set()
+        self.changed = False
+
+    def scan(self, directory):
+        directory = path.abspath(directory)
+        self.remove(directory)
+        vdis = read_vdis(scan_directories([directory]), scanning=True,
+                         threads=self.threads, cache=self.cache,
+                         incomplete=self.incomplete)
+        for filename, vdi in vdis.iteritems():
+            self.vdis[path.abspath(filename)] = vdi
+        self.changed = True
+
+    def update(self, filename):
+        """Reread ``filename``, which may be a file or a directory.
+        """
+        filename = path.abspath(filename)
+        if path.isdir(filename):
+            self.scan(filename)
+            return
+        filename, vdi = read_vdi(filename, scanning=True, cache=self.cache,
+                                 incomplete=self.incomplete)
+        if vdi:
+            self.vdis[filename] = vdi
+            self.changed = True
+        elif filename in self.vdis:
+            del self.vdis[filename]
+            self.changed = True
+
+    def remove(self, filename):
+        """Forget about ``filename``, and anything below it if it was a
+        directory.
+        """
+        filename = path.abspath(filename)
+        prefix = filename.rstrip(os.sep) + os.sep
+        for name in [name for name in self.vdis
+                     if name == filename or name.startswith(prefix)]:
+            del self.vdis[name]
+            self.changed = True
+        for name in [name for name in self.incomplete
+                     if name == filename or name.startswith(prefix)]:
+            self.incomplete.discard(name)
+
+    def tree(self):
+        self.changed = False
+        return construct_tree(self.vdis)
+
+
+if pyinotify:
+    class IndexUpdater(pyinotify.ProcessEvent):
+        def my_init(self, index, interval=0):
+            self.index = index
+            self.interval = interval
+            self.retried = {}
+
+        def process_default(self, event):
+            if event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                self.index.remove(event.pathname)
+                self.retried.pop(path.abspath(event.pathname), None)
+            elif event.mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                               pyinotify.IN_CREATE):
+                self.index.update(event.pathname)
+            elif event.mask & pyinotify.IN_MODIFY:
+                # Images which are kept open, like the snapshots of running
+                # machines, are never closed after their header has been
+                # written. Read them again, at most once every interval.
+                filename = path.abspath(event.pathname)
+                if not filename in self.index.incomplete:
+                    self.retried.pop(filename, None)
+                elif time.time() >= self.retried.get(filename, 0) + self.interval:
+                    self.retried[filename] = time.time()
+                    self.index.update(filename)
+            elif event.mask & pyinotify.IN_Q_OVERFLOW:
+                log.error('inotify queue overflow, rescanning')
+                for directory in self.index.directories:
+                    self.index.scan(directory)
+
+
+class TreeServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Sends the most recent output to every client that connects.
+    """
+    daemon_threads = True
+    output = ''
+
+    class handler_class(SocketServer.BaseRequestHandler):
+        def handle(self):
+            self.request.sendall(self.server.output)
+
+    def __init__(self, filename):
+        if path.exists(filename):
+            os.unlink(filename)
+        SocketServer.UnixStreamServer.__init__(self, filename, self.handler_class)
+
+
+def write_file(filename, data):
+    """Replace ``filename`` atomically, so readers never see a partial
+    file.
+    """
+    temp = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(temp, 'wb')
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    os.rename(temp, filename)
+
+
+def watch(options, cache=None):
+    """Maintain the tree of the images below the --scan directories from
+    inotify events, and publish it whenever it changed, at most once
+    every --interval seconds.
+    """
+    index = VDIIndex(options.scan, threads=options.threads, cache=cache)
+    manager = pyinotify.WatchManager()
+    updater = IndexUpdater(index=index, interval=options.interval)
+    notifier = pyinotify.Notifier(manager, updater,
+                                  timeout=options.interval * 1000)
+    # Watch before scanning, so no change can go unnoticed
+    mask = pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE | pyinotify.IN_DELETE | \
+        pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_MODIFY
+    manager.add_watch(index.directories, mask, rec=True, auto_add=True)
+    for directory in index.directories:
+        index.scan(directory)
+
+    server = None
+    if options.socket:
+        server = TreeServer(options.socket)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    try:
+        while True:
+            if index.changed:
+                output = StringIO()
+                print_tree(index.tree(), options, stream=output)
+                output = output.getvalue()
+                if server:
+                    server.output = output
+                if options.output:
+                    write_file(options.output, output)
+                if not server and not options.output:
+                    sys.stdout.write(output)
+                    sys.stdout.flush()
+                if cache:
+                    cache.commit()
+                published = time.time()
+                # Collect the changes of the rest of the interval
+                while time.time() < published + options.interval:
+                    remaining = published + options.interval - time.time()
+                    if notifier.check_events(max(int(remaining * 1000), 0)):
+                        notifier.read_events()
+                        notifier.process_events()
+            elif notifier.check_events():
+                notifier.read_events()
+                notifier.process_events()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        notifier.stop()
+        if server:
+            server.shutdown()
+            os.unlink(options.socket)
+
+
+def print_tree(tree, options, stream=None):
+    if options.xml:
+        print_diskmgmt_xml(tree, stream=stream)
+    elif options.json:
+        print_json(tree, stream=stream)
+    elif options.analyze:
+        print_analysis(tree, stream=stream)
+    else:
+        print_info(tree, detailed=options.detail, stream=stream)
 
 
 def parse_args(argv):
     parser = optparse.OptionParser(usage='%prog [options] filenames...')
     parser.add_option('--detail', help='print detailed VDI header info', action='store_true')
     parser.add_option('--xml', help='print XML to use in VirtualBox.xml file', action='store_true')
+    parser.add_option('--json', help='print the tree as JSON', action='store_true')
+    parser.add_option('--verify', help='check that the images of each chain fit together', action='store_true')
+    parser.add_option('--sample', help='with --verify, read this many blocks of each VDI image (default: %default)',
+                      type='int', default=0, metavar='NUM')
+    parser.add_option('--jobs', help='with --verify, number of processes reading blocks (default: one per CPU)',
+                      type='int', metavar='NUM')
+    parser.add_option('--analyze', help='print block usage and fragmentation of each image', action='store_true')
+    parser.add_option('--scan', help='search this directory tree for disk images (can be given multiple times)',
+                      action='append', metavar='DIR', default=[])
+    parser.add_option('--threads', help='number of headers to read at the same time (default: %default)',
+                      type='int', default=16)
+    parser.add_option('--cache', help='keep parsed headers in this file, and reuse them for unchanged files',
+                      metavar='FILE')
+    parser.add_option('--watch', help='keep running, and update the tree as images in the --scan directories change',
+                      action='store_true')
+    parser.add_option('--output', help='with --watch, write the tree to this file', metavar='FILE')
+    parser.add_option('--socket', help='with --watch, serve the tree on this unix socket', metavar='FILE')
+    parser.add_option('--interval', help='with --watch, update the output at most every this many seconds (default: %default)',
+                      type='int', default=5)
     options, filenames = parser.parse_args(argv)
-    if not filenames:
+    if not filenames and not options.scan:
         parser.print_help()
         sys.exit(1)
+    if options.watch:
+        if not pyinotify:
+            parser.error('--watch requires the pyinotify module')
+        if filenames or not options.scan:
+            parser.error('--watch only works with --scan directories')
     return options, filenames
 
 
 def main(argv):
     options, filenames = parse_args(argv)
-    vdi_tree = construct_tree(read_vdis(filenames))
-
-    if options.xml:
-        print_diskmgmt_xml(vdi_tree)
-    else:
-        print_info(vdi_tree, detailed=options.detail)
+    cache = HeaderCache(options.cache) if options.cache else None
+    if options.watch:
+        try:
+            watch(options, cache)
+        finally:
+            if cache:
+                cache.close()
+        return
+
+    try:
+        vdis = read_vdis(filenames, threads=options.threads, cache=cache)
+        if options.scan:
+            vdis.update(read_vdis(scan_directories(options.scan), scanning=True,
+                                  threads=options.threads, cache=cache))
+    finally:
+        if cache:
+            cache.close()
+    vdi_tree = construct_tree(vdis)
+    if options.verify:
+        return print_verification(vdi_tree, options.sample, options.jobs)
+    print_tree(vdi_tree, options)
 
 
 if __name__ == '__main__':